@@ -1,15 +1,52 @@
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
 import pytesseract
-from PIL import Image
+from PIL import Image, ImageOps
 import pdfplumber
+import pypdfium2
+import hashlib
+import io
+import multiprocessing
+import os
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+
+# optional (not in requirements.txt): in-process OCR; without it we shell out to tesseract
+try:
+    from tesserocr import OEM, PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
 
 app = Flask(__name__)
 CORS(app)
 
 pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
+# render scanned PDF pages at this DPI before OCR
+OCR_DPI = 200
+
+# larger images are shrunk to this many pixels on the longest side before OCR
+# (an A4 page rendered at OCR_DPI is ~2339px, so it is left alone)
+OCR_MAX_SIDE = 2400
+
+# LSTM engine only (skips loading the legacy engine)
+TESSERACT_ARGS = ["--oem", "1"]
+
+# extracted text is kept for this many recent uploads
+TEXT_CACHE_SIZE = 32
+
+# PDFs with at least this many pages are parsed in worker processes
+PARALLEL_PDF_PAGES = 8
+# per server process (each gunicorn worker gets its own pool), so keep it small
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+
 # ✅ NORMAL RANGES (SAFE & COMPLETE)
 NORMAL_RANGES = {
     "Hemoglobin": (12, 15),
@@ -42,42 +79,243 @@ NORMAL_RANGES = {
 
 
 # ---------- TEXT EXTRACT ----------
+_text_cache = OrderedDict()
+_text_cache_lock = threading.Lock()
+
+
+def extract_text(file):
+    stream = file.stream
+    is_pdf = file.filename.lower().endswith(".pdf")
+
+    # ✅ SAME FILE UPLOADED AGAIN -> SKIP OCR / PDF PARSING
+    key = (is_pdf, file_digest(stream))
+    with _text_cache_lock:
+        if key in _text_cache:
+            _text_cache.move_to_end(key)
+            return _text_cache[key]
+
+    # large uploads are spooled to disk by werkzeug, so read from the stream
+    # instead of copying the whole file into memory
+    if is_pdf:
+        text = extract_pdf_text(stream)
+    else:
+        text = extract_image_text(stream)
+
+    with _text_cache_lock:
+        _text_cache[key] = text
+        if len(_text_cache) > TEXT_CACHE_SIZE:
+            _text_cache.popitem(last=False)
+
+    return text
+
+
+def file_digest(stream):
+    h = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+
 def extract_pdf_text(file):
-    text = ""
     with pdfplumber.open(file) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text() or ""
+        texts = None
+        if len(pdf.pages) >= PARALLEL_PDF_PAGES:
+            texts = extract_pages_parallel(file, len(pdf.pages))
+        if texts is None:
+            texts = [extract_page_text(page) for page in pdf.pages]
+
+        # ✅ SCANNED PAGES (NO TEXT LAYER) -> OCR, RENDERED ONE AT A TIME
+        scanned = [i for i, page_text in enumerate(texts) if not page_text.strip()]
+        if scanned:
+            for i, page_text in zip(scanned, ocr_images(render_pages(file, scanned))):
+                texts[i] = page_text
+
+    return "\n".join(texts)
+
+
+def extract_page_text(page):
+    text = page.extract_text() or ""
+    # free the parsed chars/layout before moving to the next page
+    page.close()
     return text
 
 
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def extract_pages_parallel(file, n_pages):
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn everywhere: never fork a multi-threaded server holding the OCR engine
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        pool = _pdf_pool
+
+    # one contiguous (1-based) page range per worker, so each opens the PDF once
+    step = -(-n_pages // PDF_WORKERS)
+    chunks = [list(range(start + 1, min(start + step, n_pages) + 1)) for start in range(0, n_pages, step)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "report.pdf")
+
+        # pdfplumber still reads from this stream, so put it back where it was
+        pos = file.tell()
+        file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(file, f)
+        file.seek(pos)
+
+        try:
+            results = pool.map(extract_page_range, repeat(path), chunks)
+            return [text for chunk in results for text in chunk]
+        except BrokenProcessPool:
+            # ✅ A WORKER DIED (OOM / CRASH) -> NEW POOL NEXT TIME, PARSE THIS ONE SERIALLY
+            with _pdf_pool_lock:
+                if _pdf_pool is pool:
+                    _pdf_pool = None
+            pool.shutdown(wait=False)
+            return None
+
+
+def extract_page_range(path, page_numbers):
+    with pdfplumber.open(path, pages=page_numbers) as pdf:
+        return [extract_page_text(page) for page in pdf.pages]
+
+
+# PDFium is not thread-safe: no two calls may overlap, even on different documents
+_pdfium_lock = threading.Lock()
+
+
+def render_pages(file, page_indexes):
+    # ✅ ONE PDFIUM DOCUMENT FOR ALL SCANNED PAGES (page.to_image REOPENS IT PER PAGE)
+    with _pdfium_lock:
+        doc = pypdfium2.PdfDocument(file)
+    try:
+        for i in page_indexes:
+            # lock each render, never across the yield
+            with _pdfium_lock:
+                page = doc[i]
+                img = page.render(scale=OCR_DPI / 72, grayscale=True).to_pil()
+                page.close()
+            yield img
+    finally:
+        with _pdfium_lock:
+            doc.close()
+
+
 def extract_image_text(file):
     img = Image.open(file)
+    return ocr_image(prepare_ocr_image(img))
+
+
+# ---------- OCR ----------
+# ✅ LOAD THE MODEL AT STARTUP, NOT ON THE FIRST UPLOAD
+# (skipped in PDF pool workers: they re-import this module but never OCR)
+_ocr_api = None
+if PyTessBaseAPI is not None and multiprocessing.parent_process() is None:
+    try:
+        _ocr_api = PyTessBaseAPI(oem=OEM.LSTM_ONLY)
+    except RuntimeError as e:
+        # e.g. missing / mismatched tessdata: fall back to the tesseract binary
+        app.logger.warning("tesserocr init failed, using tesseract binary: %s", e)
+_ocr_lock = threading.Lock()
+
+
+def prepare_ocr_image(img):
     img = img.convert("L")
-    return pytesseract.image_to_string(img)
+    # ✅ PHONE PHOTOS (4000x3000+) -> SANE SIZE, OCR TIME SCALES WITH PIXELS
+    img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    # ✅ STRETCH FADED SCANS / PHOTOS TO FULL CONTRAST
+    return ImageOps.autocontrast(img)
+
+
+def ocr_image(img):
+    if _ocr_api is None:
+        # ✅ PIPE THE IMAGE OVER STDIN (NO PNG ENCODE, NO TEMP FILES)
+        buf = io.BytesIO()
+        img.save(buf, format="TIFF")
+        try:
+            out = subprocess.run(
+                [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout", *TESSERACT_ARGS],
+                input=buf.getvalue(),
+                capture_output=True,
+                check=True,
+            )
+        # same errors as the pytesseract batch path, with tesseract's own message
+        except FileNotFoundError:
+            raise pytesseract.TesseractNotFoundError() from None
+        except subprocess.CalledProcessError as e:
+            raise pytesseract.TesseractError(e.returncode, e.stderr.decode("utf-8", "replace").strip()) from e
+        return out.stdout.decode("utf-8")
+
+    # ✅ IN-PROCESS TESSERACT (NO SUBPROCESS, MODEL STAYS LOADED)
+    with _ocr_lock:
+        _ocr_api.SetImage(img)
+        return _ocr_api.GetUTF8Text()
+
+
+def ocr_images(images):
+    if _ocr_api is not None:
+        return [ocr_image(prepare_ocr_image(img)) for img in images]
+
+    # ✅ ONE TESSERACT RUN FOR ALL PAGES (MODEL LOADS ONCE)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i, img in enumerate(images):
+            path = os.path.join(tmp, f"page_{i}.png")
+            prepare_ocr_image(img).save(path)
+            paths.append(path)
+
+        list_path = os.path.join(tmp, "pages.txt")
+        with open(list_path, "w") as f:
+            f.write("\n".join(paths))
+
+        text = pytesseract.image_to_string(list_path, config=" ".join(TESSERACT_ARGS))
+
+    # tesseract ends every page with a form feed
+    return text.split("\f")
 
 
 # ---------- X-RAY EXTRACT ----------
+XRAY_KEYWORDS = ("FINDINGS", "IMPRESSION", "IMPRESSIONS", "OPINION", "CONCLUSION", "RECOMMENDATION")
+_XRAY_KEYWORD_LEN = max(map(len, XRAY_KEYWORDS))
+
+
+def xray_section(line):
+    # keyword (or its plural) must start the line and end the word:
+    # "Findings:" / "Impressions -" yes, "Opinionated" / "Findingsless" no
+    u = line.lstrip()[:_XRAY_KEYWORD_LEN + 2].upper()
+    if u.startswith(XRAY_KEYWORDS):
+        for key in XRAY_KEYWORDS:
+            end = len(key) + u.startswith("S", len(key))
+            if u.startswith(key) and not u[end:end + 1].isalpha():
+                return key.title()
+    return None
+
+
 def extract_xray_report(text):
     report = {}
-    keywords = ["FINDINGS", "IMPRESSION", "IMPRESSIONS", "OPINION", "CONCLUSION", "RECOMMENDATION"]
 
     lines = text.split("\n")
     current = None
     buffer = ""
 
     for line in lines:
-        u = line.strip().upper()
-
-        for key in keywords:
-            if key in u:
-                if current:
-                    report[current] = buffer.strip()
-                current = key.title()
-                buffer = ""
-                break
-        else:
+        # ✅ HEADER = LINE STARTING WITH A KEYWORD ("no acute findings" IS BODY TEXT)
+        section = xray_section(line)
+
+        if section:
             if current:
-                buffer += " " + line
+                report[current] = buffer.strip()
+            current = section
+            buffer = ""
+        elif current:
+            buffer += " " + line
 
     if current:
         report[current] = buffer.strip()
@@ -86,61 +324,78 @@ def extract_xray_report(text):
 
 
 # ---------- OCR CLEAN (NO NUMBER CHANGE) ----------
+OCR_REPLACEMENTS = {
+    "Hem0g10bin": "Hemoglobin",
+    "Rec": "RBC",
+    "yer": "HCT",
+    "pur": "PLT",
+    "wec": "WBC",
+    "M0N": "MON",
+    "R0WcV": "RDW-CV",
+    "R0W-SD": "RDW-SD",
+}
+
+# ✅ ONE PASS FOR ALL WORD FIXES, ONE PASS FOR CHAR FIXES
+# keys with a zero are OCR-only spellings and may sit inside a word ("M0NOCYTES");
+# short lowercase keys must start a word and not run into more letters, so
+# "Recommendation" / "purpose" stay intact but "Rec4.5" is still fixed
+_OCR_ZERO_KEYS = [k for k in OCR_REPLACEMENTS if "0" in k]
+_OCR_WORD_KEYS = [k for k in OCR_REPLACEMENTS if "0" not in k]
+_OCR_REPLACEMENTS_RE = re.compile(
+    "|".join(map(re.escape, _OCR_ZERO_KEYS))
+    + r"|\b(?:" + "|".join(map(re.escape, _OCR_WORD_KEYS)) + r")(?![a-z])"
+)
+# l / | misread for 1, but only touching a digit ("l2.5", "1|0") so words
+# like "Platelet", "Cells" and "Conclusion" survive
+_OCR_DIGIT_CONFUSABLES_RE = re.compile(r"(?<=\d)[l|]+|[l|]+(?=\d)")
+
+
 def normalize_text(text):
-    replacements = {
-        "Hem0g10bin": "Hemoglobin",
-        "Rec": "RBC",
-        "yer": "HCT",
-        "pur": "PLT",
-        "wec": "WBC",
-        "M0N": "MON",
-        "R0WcV": "RDW-CV",
-        "R0W-SD": "RDW-SD",
-    }
-
-    for wrong, correct in replacements.items():
-        text = text.replace(wrong, correct)
-
-    text = text.replace("l", "1").replace("|", "1")
-    return text
+    text = _OCR_REPLACEMENTS_RE.sub(lambda m: OCR_REPLACEMENTS[m.group(0)], text)
+    return _OCR_DIGIT_CONFUSABLES_RE.sub(lambda m: "1" * len(m.group(0)), text)
 
 
 # ---------- VALUE EXTRACTION ----------
+VALUE_PATTERNS = {
+    # not the HbA1c / MCH rows ("GLYCATED HEMOGLOBIN", "MEAN CORPUSCULAR HEMOGLOBIN")
+    "Hemoglobin": r"(?<!CORPUSCULAR\s)(?<!GLYCATED\s)(?<!GLYCOSYLATED\s)HA?EMOGLOBIN\s*(?:\(HB\)\s*)?([\d\.]+)",
+    "PCV": r"PCV\s*([\d\.]+)",
+    "RBC": r"RBC\s*([\d\.]+)",
+    "MCV": r"MCV\s*([\d\.]+)",
+    "MCH": r"MCH\s*([\d\.]+)",
+    "MCHC": r"MCHC\s*([\d\.]+)",
+    "RDW": r"R\.?D\.?W\s*([\d\.]+)",
+    "HCT": r"HCT\s*([\d\.]+)",
+
+    "TLC": r"TOTAL LEUCOCYTE COUNT.*?([\d,]+)",
+
+    "NEUTROPHILS%": r"NEUTROPHILS\s+(\d+)\s*%",
+    "LYMPHOCYTES%": r"LYMPHOCYTES\s+(\d+)\s*%",
+    "EOSINOPHILS%": r"EOSINOPHILS\s+(\d+)\s*%",
+    "MONOCYTES%": r"MONOCYTES\s+(\d+)\s*%",
+    "BASOPHILS%": r"BASOPHILS\s+(\d+)\s*%",
+
+    "NEUTROPHILS_ABS": r"NEUTROPHILS\s+([\d\.]+)\s*Cells",
+    "LYMPHOCYTES_ABS": r"LYMPHOCYTES\s+([\d\.]+)\s*Cells",
+    "EOSINOPHILS_ABS": r"EOSINOPHILS\s+([\d\.]+)\s*Cells",
+    "MONOCYTES_ABS": r"MONOCYTES\s+([\d\.]+)\s*Cells",
+
+    "PLATELET": r"PLATELET COUNT\s*([\d,]+)",
+    "MPV": r"MPV\s*([\d\.]+)",
+    "NLR": r"NLR\s*([\d\.]+)",
+    "ESR": r"ESR\s*([\d\.]+)",
+    "WBC": r"WBC\s*([\d\.]+)"
+}
+
+# ✅ COMPILED ONCE AT IMPORT, NOT PER REPORT
+_VALUE_PATTERNS = {test: re.compile(pattern, re.IGNORECASE) for test, pattern in VALUE_PATTERNS.items()}
+
+
 def extract_values(text):
     results = {}
 
-    patterns = {
-        "Hemoglobin": r"HAEMOGLOBIN\s*([\d\.]+)",
-        "PCV": r"PCV\s*([\d\.]+)",
-        "RBC": r"RBC\s*([\d\.]+)",
-        "MCV": r"MCV\s*([\d\.]+)",
-        "MCH": r"MCH\s*([\d\.]+)",
-        "MCHC": r"MCHC\s*([\d\.]+)",
-        "RDW": r"R\.?D\.?W\s*([\d\.]+)",
-        "HCT": r"HCT\s*([\d\.]+)",
-
-        "TLC": r"TOTAL LEUCOCYTE COUNT.*?([\d,]+)",
-
-        "NEUTROPHILS%": r"NEUTROPHILS\s+(\d+)\s*%",
-        "LYMPHOCYTES%": r"LYMPHOCYTES\s+(\d+)\s*%",
-        "EOSINOPHILS%": r"EOSINOPHILS\s+(\d+)\s*%",
-        "MONOCYTES%": r"MONOCYTES\s+(\d+)\s*%",
-        "BASOPHILS%": r"BASOPHILS\s+(\d+)\s*%",
-
-        "NEUTROPHILS_ABS": r"NEUTROPHILS\s+([\d\.]+)\s*Cells",
-        "LYMPHOCYTES_ABS": r"LYMPHOCYTES\s+([\d\.]+)\s*Cells",
-        "EOSINOPHILS_ABS": r"EOSINOPHILS\s+([\d\.]+)\s*Cells",
-        "MONOCYTES_ABS": r"MONOCYTES\s+([\d\.]+)\s*Cells",
-
-        "PLATELET": r"PLATELET COUNT\s*([\d,]+)",
-        "MPV": r"MPV\s*([\d\.]+)",
-        "NLR": r"NLR\s*([\d\.]+)",
-        "ESR": r"ESR\s*([\d\.]+)",
-        "WBC": r"WBC\s*([\d\.]+)"
-    }
-
-    for test, pattern in patterns.items():
-        match = re.search(pattern, text, re.IGNORECASE)
+    for test, pattern in _VALUE_PATTERNS.items():
+        match = pattern.search(text)
         if match:
             raw = match.group(1)
             raw = raw.replace(",", "").strip()
@@ -165,16 +420,21 @@ def extract_values(text):
 
 
 # ---------- STATUS LOGIC ----------
+# "low - high" labels, built once instead of per report
+NORMAL_LABELS = {test: f"{low} - {high}" for test, (low, high) in NORMAL_RANGES.items()}
+
+
 def analyze(values):
     report = {}
 
     for test, value in values.items():
+        limits = NORMAL_RANGES.get(test)
 
         # ✅ NEVER CRASH ON UNKNOWN TEST
-        if test not in NORMAL_RANGES:
+        if limits is None:
             continue
 
-        low, high = NORMAL_RANGES[test]
+        low, high = limits
 
         if value < low:
             status = "LOW"
@@ -185,7 +445,7 @@ def analyze(values):
 
         report[test] = {
             "value": value,
-            "normal": f"{low} - {high}",
+            "normal": NORMAL_LABELS[test],
             "status": status
         }
 
@@ -203,11 +463,7 @@ def analyze_report():
 
     file = request.files["file"]
 
-    if file.filename.lower().endswith(".pdf"):
-        text = extract_pdf_text(file)
-    else:
-        text = extract_image_text(file)
-
+    text = extract_text(file)
     text = normalize_text(text)
 
     print("\n====== OCR TEXT ======")
@@ -0,0 +1,57 @@
+from app import extract_values, extract_xray_report, normalize_text
+
+
+def test_ocr_fix_inside_word():
+    # "M0N" only ever shows up as part of M0NOCYTES
+    assert extract_values(normalize_text("M0NOCYTES 05 %")) == {"MONOCYTES%": 5.0}
+
+
+def test_ocr_fix_before_digits():
+    assert extract_values(normalize_text("Rec4.5")) == {"RBC": 4.5}
+
+
+def test_ocr_fix_leaves_words_alone():
+    assert normalize_text("Recommendation purpose layer") == "Recommendation purpose layer"
+
+
+def test_xray_body_lines_stay_in_section():
+    text = (
+        "FINDINGS:\n"
+        "No acute cardiopulmonary findings.\n"
+        "Opinionated readers may differ.\n"
+        "Clinical findings: cough.\n"
+        "IMPRESSIONS:\n"
+        "Normal chest.\n"
+        "RECOMMENDATIONS:\n"
+        "None."
+    )
+    assert extract_xray_report(text) == {
+        "Findings": "No acute cardiopulmonary findings. Opinionated readers may differ. Clinical findings: cough.",
+        "Impression": "Normal chest.",
+        "Recommendation": "None.",
+    }
+
+
+def test_digit_confusables_leave_words_alone():
+    assert normalize_text("Cells Platelet Conclusion") == "Cells Platelet Conclusion"
+
+
+def test_digit_confusables_next_to_digits():
+    assert normalize_text("l2.5") == "12.5"
+    assert normalize_text("1|0") == "110"
+
+
+def test_absolute_count_survives_normalize():
+    assert extract_values(normalize_text("NEUTROPHILS 4000 Cells/cumm")) == {"NEUTROPHILS_ABS": 4000.0}
+
+
+def test_hemoglobin_both_spellings():
+    assert extract_values(normalize_text("Haemoglobin 13.5")) == {"Hemoglobin": 13.5}
+    assert extract_values(normalize_text("Hemoglobin (Hb) 13.5 g/dL")) == {"Hemoglobin": 13.5}
+
+
+def test_hemoglobin_skips_hba1c_and_mch_rows():
+    text = "GLYCATED HEMOGLOBIN 5.6 %\nHemoglobin 13.5"
+    assert extract_values(normalize_text(text)) == {"Hemoglobin": 13.5}
+    text = "Mean Corpuscular Hemoglobin 29.0 pg\nGlycosylated Haemoglobin 6.1 %"
+    assert extract_values(normalize_text(text)) == {}